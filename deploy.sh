@@ -82,7 +82,7 @@ Type=simple
 User=$APP_USER
 WorkingDirectory=$APP_DIR
 EnvironmentFile=$APP_DIR/.env
-ExecStart=$APP_DIR/venv/bin/uvicorn main:app --host 0.0.0.0 --port 8080 --workers 2
+ExecStart=$APP_DIR/venv/bin/gunicorn main:app -k uvicorn_worker.UvicornWorker -w $((2 * $(nproc) + 1)) --bind 0.0.0.0:8080
 Restart=always
 RestartSec=5
 
@@ -5,24 +5,35 @@ A learning project for managing STL files with AI assistance
 
 import os
 import json
+import logging
+import re
+import asyncio
+import time
+import hashlib
 import mimetypes
 import shutil
+from asyncio.subprocess import PIPE
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 import httpx
-import aiofiles
+from cachetools import TTLCache
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, HTTPException, UploadFile, File, Depends, Form
-from fastapi.responses import HTMLResponse, JSONResponse, FileResponse, RedirectResponse
+from fastapi import FastAPI, Request, Response, HTTPException, UploadFile, File, Depends, Form, Query
+from fastapi.responses import (
+    HTMLResponse, JSONResponse, FileResponse, ORJSONResponse, RedirectResponse, StreamingResponse,
+)
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from jose import jwt, JWTError
-import anthropic
-from openai import OpenAI
+from anthropic import AsyncAnthropic
+from openai import AsyncOpenAI
 
 load_dotenv()
+logger = logging.getLogger("stl-hub")
 
 # ── Config ──────────────────────────────────────────────────────────────────
 SECRET_KEY       = os.getenv("SECRET_KEY", "dev_secret_change_me")
@@ -36,12 +47,68 @@ ALLOWED_EMAILS   = [e.strip() for e in os.getenv("ALLOWED_EMAILS", "").split(","
 
 ALGORITHM  = "HS256"
 TOKEN_EXPIRE_HOURS = 8
+TOKEN_CACHE_TTL    = 60  # seconds a decoded token is trusted before re-verifying
+IO_CHUNK_SIZE      = 1 << 20  # 1 MiB, for upload and download copies
+
+# Shared outbound client so TLS sessions to Google stay warm between logins
+HTTP_CLIENT = httpx.AsyncClient(
+    http2=True,
+    timeout=10.0,
+    limits=httpx.Limits(max_keepalive_connections=20),
+)
+
 
 # ── App ──────────────────────────────────────────────────────────────────────
-app = FastAPI(title="STL Hub", version="1.0.0")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await HTTP_CLIENT.aclose()
+    # Only close the AI clients that were actually created
+    if anthropic_client.cache_info().currsize:
+        await anthropic_client().close()
+    if openai_client.cache_info().currsize:
+        await openai_client().close()
+
+
+app = FastAPI(title="STL Hub", version="1.0.0", lifespan=lifespan, default_response_class=ORJSONResponse)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if the client's If-None-Match already names ``etag`` (weak comparison)."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+def _load_page(name: str) -> tuple[bytes, str]:
+    """Read a static HTML page and derive a content-hash ETag for it."""
+    body = Path("static", name).read_bytes()
+    return body, f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+
+
+# HTML pages are read once at startup; restart the app to pick up edits
+_PAGES = {
+    name: _load_page(name)
+    for name in ("index.html", "app.html", "terminal.html")
+    if Path("static", name).is_file()
+}
+
+
+def page(request: Request, name: str) -> Response:
+    if name not in _PAGES:
+        raise HTTPException(status_code=404, detail="Page not found")
+    body, etag = _PAGES[name]
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    return HTMLResponse(body, headers=headers)
+
+
 # Ensure file storage directory exists
 FTP_ROOT.mkdir(parents=True, exist_ok=True)
 
@@ -53,6 +120,10 @@ def create_token(data: dict) -> str:
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
 
+# Decoded claims keyed by token hash -> (payload, cache expiry timestamp)
+_token_cache: TTLCache = TTLCache(maxsize=4096, ttl=TOKEN_CACHE_TTL)
+
+
 def decode_token(token: str) -> dict:
     try:
         return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
@@ -60,11 +131,27 @@ def decode_token(token: str) -> dict:
         raise HTTPException(status_code=401, detail="Invalid or expired session")
 
 
+def _cached_decode(token: str) -> dict:
+    """Decode a session token, reusing recently verified claims for the same token."""
+    key = hashlib.sha256(token.encode()).hexdigest()[:16]
+    now = time.time()
+    cached = _token_cache.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+
+    payload = decode_token(token)  # raises 401 on bad tokens, which are never cached
+    # Never trust the cached copy past the token's own expiry
+    expires = min(now + TOKEN_CACHE_TTL, payload.get("exp", now))
+    if expires > now:
+        _token_cache[key] = (payload, expires)
+    return payload
+
+
 def get_current_user(request: Request) -> dict:
     token = request.cookies.get("session_token")
     if not token:
         raise HTTPException(status_code=401, detail="Not authenticated")
-    return decode_token(token)
+    return _cached_decode(token)
 
 
 def optional_user(request: Request) -> Optional[dict]:
@@ -72,43 +159,87 @@ def optional_user(request: Request) -> Optional[dict]:
     if not token:
         return None
     try:
-        return decode_token(token)
+        return _cached_decode(token)
     except Exception:
         return None
 
 
 # ── File helpers ──────────────────────────────────────────────────────────────
+@lru_cache(maxsize=None)
+def _resolved_root() -> str:
+    """Create and resolve the files root once; it is stable for the process lifetime."""
+    FTP_ROOT.mkdir(parents=True, exist_ok=True)
+    return str(FTP_ROOT.resolve())
+
+
 def safe_path(relative: str = "") -> Path:
     """Return a safe absolute path within the shared files root."""
-    FTP_ROOT.mkdir(parents=True, exist_ok=True)
+    root = _resolved_root()
     if not relative or relative in (".", "/", ""):
         return FTP_ROOT
     resolved = (FTP_ROOT / relative).resolve()
-    if not str(resolved).startswith(str(FTP_ROOT.resolve())):
+    # commonpath compares whole components, so /files-old is not inside /files
+    if os.path.commonpath([root, str(resolved)]) != root:
         raise HTTPException(status_code=400, detail="Invalid path")
     return resolved
 
 
-def file_info(path: Path, base: Path) -> dict:
-    stat = path.stat()
+@lru_cache(maxsize=4096)
+def _format_minute(minute: int) -> str:
+    """Local "YYYY-MM-DD HH:MM" for an epoch minute; files saved together share an entry."""
+    t = time.localtime(minute * 60)
+    return f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d} {t.tm_hour:02d}:{t.tm_min:02d}"
+
+
+def file_info(entry: os.DirEntry, parent: str) -> dict:
+    """Describe a directory entry; ``parent`` is its folder relative to the files root."""
+    stat = entry.stat()
+    is_dir = entry.is_dir()
     return {
-        "name": path.name,
-        "path": str(path.relative_to(base)),
-        "is_dir": path.is_dir(),
-        "size": stat.st_size if path.is_file() else 0,
-        "modified": datetime.fromtimestamp(stat.st_mtime).strftime("%Y-%m-%d %H:%M"),
-        "is_stl": path.suffix.lower() == ".stl",
+        "name": entry.name,
+        "path": f"{parent}/{entry.name}" if parent else entry.name,
+        "is_dir": is_dir,
+        "size": 0 if is_dir else stat.st_size,
+        "modified": _format_minute(int(stat.st_mtime // 60)),
+        "is_stl": entry.name[-4:].lower() == ".stl",
     }
 
 
+def _scan(target: Path, base: Path, offset: int, limit: int) -> tuple[list[dict], int]:
+    """List one page of a folder (dirs first, then by name); returns (items, total entries)."""
+    parent = target.relative_to(base).as_posix()
+    if parent == ".":
+        parent = ""
+    with os.scandir(target) as it:
+        entries = sorted(it, key=lambda e: (not e.is_dir(), e.name.lower()))
+    return [file_info(entry, parent) for entry in entries[offset:offset + limit]], len(entries)
+
+
+def _blocking_save(src, dest: Path) -> int:
+    """Copy an upload's spooled file to disk in one thread hop; returns bytes written."""
+    with open(dest, "wb", buffering=IO_CHUNK_SIZE) as out:
+        shutil.copyfileobj(src, out, length=IO_CHUNK_SIZE)
+        return out.tell()
+
+
+class DownloadResponse(FileResponse):
+    """FileResponse that reads 1 MiB per thread hop instead of 64 KiB for big STL downloads."""
+    chunk_size = IO_CHUNK_SIZE
+
+    @staticmethod
+    def etag_for(st: os.stat_result) -> str:
+        """The ETag Starlette sets for ``st``; If-Range is checked against this exact format."""
+        base = f"{st.st_mtime}-{st.st_size}"
+        return f'"{hashlib.md5(base.encode(), usedforsecurity=False).hexdigest()}"'
+
+
 # ── Routes: root ─────────────────────────────────────────────────────────────
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
     user = optional_user(request)
     if user:
         return RedirectResponse("/files")
-    with open("static/index.html") as f:
-        return HTMLResponse(f.read())
+    return page(request, "index.html")
 
 
 # ── Routes: Google OAuth ──────────────────────────────────────────────────────
@@ -128,26 +259,25 @@ async def auth_google():
 @app.get("/auth/google/callback")
 async def auth_google_callback(code: str, request: Request):
     # Exchange code for token
-    async with httpx.AsyncClient() as client:
-        token_resp = await client.post(
-            "https://oauth2.googleapis.com/token",
-            data={
-                "code": code,
-                "client_id": GOOGLE_CLIENT_ID,
-                "client_secret": GOOGLE_CLIENT_SECRET,
-                "redirect_uri": f"{APP_BASE_URL}/auth/google/callback",
-                "grant_type": "authorization_code",
-            },
-        )
-        token_data = token_resp.json()
-        if "error" in token_data:
-            raise HTTPException(status_code=400, detail=token_data.get("error_description", "OAuth error"))
+    token_resp = await HTTP_CLIENT.post(
+        "https://oauth2.googleapis.com/token",
+        data={
+            "code": code,
+            "client_id": GOOGLE_CLIENT_ID,
+            "client_secret": GOOGLE_CLIENT_SECRET,
+            "redirect_uri": f"{APP_BASE_URL}/auth/google/callback",
+            "grant_type": "authorization_code",
+        },
+    )
+    token_data = token_resp.json()
+    if "error" in token_data:
+        raise HTTPException(status_code=400, detail=token_data.get("error_description", "OAuth error"))
 
-        user_resp = await client.get(
-            "https://www.googleapis.com/oauth2/v3/userinfo",
-            headers={"Authorization": f"Bearer {token_data['access_token']}"},
-        )
-        user_info = user_resp.json()
+    user_resp = await HTTP_CLIENT.get(
+        "https://www.googleapis.com/oauth2/v3/userinfo",
+        headers={"Authorization": f"Bearer {token_data['access_token']}"},
+    )
+    user_info = user_resp.json()
 
     email = user_info.get("email", "")
     if ALLOWED_EMAILS and email not in ALLOWED_EMAILS:
@@ -175,12 +305,16 @@ async def logout():
 @app.get("/files", response_class=HTMLResponse)
 async def files_page(request: Request):
     get_current_user(request)  # require auth
-    with open("static/app.html") as f:
-        return HTMLResponse(f.read())
+    return page(request, "app.html")
 
 
-@app.get("/api/files")
-async def list_files(request: Request, path: str = ""):
+@app.get("/api/files", response_class=ORJSONResponse)
+async def list_files(
+    request: Request,
+    path: str = "",
+    offset: int = Query(0, ge=0),
+    limit: int = Query(500, ge=1, le=5000),
+):
     user = get_current_user(request)
     base = safe_path()
     target = safe_path(path)
@@ -188,10 +322,12 @@ async def list_files(request: Request, path: str = ""):
     if not target.exists():
         raise HTTPException(status_code=404, detail="Path not found")
 
-    items = sorted(target.iterdir(), key=lambda p: (p.is_file(), p.name.lower()))
+    items, total = await asyncio.to_thread(_scan, target, base, offset, limit)
     return {
         "path": path,
-        "items": [file_info(item, base) for item in items],
+        "items": items,
+        "total": total,
+        "offset": offset,
         "user": {"email": user["email"], "name": user["name"], "picture": user.get("picture", "")},
     }
 
@@ -200,10 +336,8 @@ async def list_files(request: Request, path: str = ""):
 async def upload_file(request: Request, path: str = Form(""), file: UploadFile = File(...)):
     user = get_current_user(request)
     dest = safe_path(path) / file.filename
-    async with aiofiles.open(dest, "wb") as out:
-        content = await file.read()
-        await out.write(content)
-    return {"message": f"Uploaded {file.filename}", "size": len(content)}
+    size = await asyncio.to_thread(_blocking_save, file.file, dest)
+    return {"message": f"Uploaded {file.filename}", "size": size}
 
 
 @app.get("/api/files/download")
@@ -212,7 +346,11 @@ async def download_file(request: Request, path: str):
     target = safe_path(path)
     if not target.is_file():
         raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(target, filename=target.name)
+    st = target.stat()
+    etag = DownloadResponse.etag_for(st)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return DownloadResponse(target, filename=target.name, stat_result=st)
 
 
 @app.delete("/api/files/delete")
@@ -237,6 +375,58 @@ async def make_dir(request: Request, path: str = Form(...), name: str = Form(...
 
 
 # ── Routes: AI Chat ────────────────────────────────────────────────────────────
+@lru_cache(maxsize=None)
+def anthropic_client() -> AsyncAnthropic:
+    """Shared Anthropic client so its connection pool survives between chat turns."""
+    if not ANTHROPIC_API_KEY:
+        raise HTTPException(status_code=503, detail="Anthropic API key not configured")
+    return AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+
+
+@lru_cache(maxsize=None)
+def openai_client() -> AsyncOpenAI:
+    """Shared OpenAI client so its connection pool survives between chat turns."""
+    if not OPENAI_API_KEY:
+        raise HTTPException(status_code=503, detail="OpenAI API key not configured")
+    return AsyncOpenAI(api_key=OPENAI_API_KEY)
+
+
+async def _anthropic_deltas(client: AsyncAnthropic, model: str, system: str, messages: list):
+    async with client.messages.stream(
+        model=model,
+        max_tokens=1024,
+        system=system,
+        messages=messages,
+    ) as stream:
+        async for text in stream.text_stream:
+            yield text
+
+
+async def _openai_deltas(client: AsyncOpenAI, model: str, messages: list):
+    stream = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        max_tokens=1024,
+        stream=True,
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+async def _sse_events(deltas, model_label: str):
+    """Relay model text as SSE: a ``model`` event, ``delta`` events, then ``done``."""
+    yield f"data: {json.dumps({'model': model_label})}\n\n"
+    try:
+        async for text in deltas:
+            yield f"data: {json.dumps({'delta': text})}\n\n"
+    except Exception:
+        # Headers are already sent, so report provider errors in-band without SDK details
+        logger.exception("Chat stream failed (%s)", model_label)
+        yield f"data: {json.dumps({'error': 'The AI provider returned an error'})}\n\n"
+    yield f"data: {json.dumps({'done': True})}\n\n"
+
+
 @app.post("/api/chat")
 async def chat(request: Request):
     user = get_current_user(request)
@@ -271,100 +461,86 @@ async def chat(request: Request):
 
     if model_choice == "claude":
         # Claude claude-sonnet-4-6
-        client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+        client = anthropic_client()
         chat_messages = [{"role": m["role"], "content": m["content"]} for m in messages]
         if prompt:
             chat_messages.append({"role": "user", "content": prompt})
-        response = client.messages.create(
-            model="claude-sonnet-4-6",
-            max_tokens=1024,
-            system=system_msg,
-            messages=chat_messages,
-        )
-        reply = response.content[0].text
+        deltas = _anthropic_deltas(client, "claude-sonnet-4-6", system_msg, chat_messages)
         model_label = "Claude Sonnet 4.6"
 
     elif model_choice == "claude-opus":
         # Claude Opus claude-opus-4-6
-        client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+        client = anthropic_client()
         chat_messages = [{"role": m["role"], "content": m["content"]} for m in messages]
         if prompt:
             chat_messages.append({"role": "user", "content": prompt})
-        response = client.messages.create(
-            model="claude-opus-4-6",
-            max_tokens=1024,
-            system=system_msg,
-            messages=chat_messages,
-        )
-        reply = response.content[0].text
+        deltas = _anthropic_deltas(client, "claude-opus-4-6", system_msg, chat_messages)
         model_label = "Claude Opus 4.6"
 
     elif model_choice == "gpt":
         # GPT-4o
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        client = openai_client()
         oai_messages = [{"role": "system", "content": system_msg}]
         oai_messages += [{"role": m["role"], "content": m["content"]} for m in messages]
         if prompt:
             oai_messages.append({"role": "user", "content": prompt})
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=oai_messages,
-            max_tokens=1024,
-        )
-        reply = response.choices[0].message.content
+        deltas = _openai_deltas(client, "gpt-4o", oai_messages)
         model_label = "GPT-4o"
 
     elif model_choice == "gpt-mini":
         # GPT-4o-mini
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        client = openai_client()
         oai_messages = [{"role": "system", "content": system_msg}]
         oai_messages += [{"role": m["role"], "content": m["content"]} for m in messages]
         if prompt:
             oai_messages.append({"role": "user", "content": prompt})
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=oai_messages,
-            max_tokens=1024,
-        )
-        reply = response.choices[0].message.content
+        deltas = _openai_deltas(client, "gpt-4o-mini", oai_messages)
         model_label = "GPT-4o Mini"
 
     else:
         raise HTTPException(status_code=400, detail="Unknown model")
 
-    return {"reply": reply, "model": model_label}
+    return StreamingResponse(
+        _sse_events(deltas, model_label),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
 
 
 # ── Routes: Terminal (SSH passthrough) ────────────────────────────────────────
 @app.get("/terminal", response_class=HTMLResponse)
 async def terminal_page(request: Request):
     get_current_user(request)
-    with open("static/terminal.html") as f:
-        return HTMLResponse(f.read())
+    return page(request, "terminal.html")
+
+
+DANGEROUS_COMMANDS = ["rm -rf", "mkfs", "dd if=", ":(){:|:&};:", "shutdown", "reboot", "passwd"]
+_DANGEROUS_RE = re.compile("|".join(map(re.escape, DANGEROUS_COMMANDS)))
 
 
 @app.post("/api/terminal/exec")
 async def terminal_exec(request: Request):
     """Execute a shell command on the VPS (admin only)."""
-    import subprocess
     user = get_current_user(request)
     body = await request.json()
     cmd = body.get("cmd", "")
 
     # Safety: only allow non-destructive commands for non-admins
     # Admin emails can run anything; others get a restricted set
-    dangerous = ["rm -rf", "mkfs", "dd if=", ":(){:|:&};:", "shutdown", "reboot", "passwd"]
-    if any(d in cmd for d in dangerous):
+    if _DANGEROUS_RE.search(cmd):
         return {"output": "⛔ Command blocked for safety.", "exit_code": 1}
 
     try:
-        result = subprocess.run(
-            cmd, shell=True, capture_output=True, text=True, timeout=15,
-            cwd=str(FTP_ROOT)
+        proc = await asyncio.create_subprocess_shell(
+            cmd, stdout=PIPE, stderr=PIPE, cwd=str(FTP_ROOT)
         )
-        output = result.stdout + result.stderr
-        return {"output": output or "(no output)", "exit_code": result.returncode}
-    except subprocess.TimeoutExpired:
-        return {"output": "Command timed out (15s limit)", "exit_code": 1}
+        try:
+            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=15)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return {"output": "Command timed out (15s limit)", "exit_code": 1}
+        output = stdout.decode(errors="replace") + stderr.decode(errors="replace")
+        return {"output": output or "(no output)", "exit_code": proc.returncode}
     except Exception as e:
         return {"output": str(e), "exit_code": 1}